@@ -47,6 +47,8 @@ If `execute_query` fails:
 
 - If the error mentions a missing or incorrect table/column name (schema error), revisit the output of **fetch_schema_tables** to correct the mistake.
 
+- If the query was rejected for being too expensive, use the plan summary to rewrite it with filters, a LIMIT or fewer joins.
+
 ---
 
 Repeat the appropriate tool actions until the query succeeds or until the 9-step cycle limit is reached.
@@ -2,6 +2,7 @@ from dataclasses import dataclass, field
 from langchain_core.tools import tool
 from collections import defaultdict
 from dotenv import load_dotenv
+from math import isfinite
 from os import getenv
 import psycopg2
 
@@ -328,6 +329,220 @@ def fetch_schema_tables() -> list[Table]:
         # raise RuntimeError(f"Crash while getting tables from schema:\n{err}")
 
 
+PLAN_CONDITIONS = ["Hash Cond", "Merge Cond", "Join Filter", "Index Cond", "Recheck Cond", "Filter"]
+COST_ACTIONS = {"reject", "limit"}
+
+
+@dataclass
+class PlanNode:
+    node_type: str
+    # Cost of the node across every time it runs, nodes on the inner side
+    # of a nested loop run once per outer row
+    total_cost: float
+    plan_rows: int
+    # Cost of this node without the cost of the nodes below it
+    own_cost: float = 0
+    relation_name: str | None = None
+    conditions: list[str] = field(default_factory=list)
+    cross_join: bool = False
+
+    def __str__(self) -> str:
+        result = self.node_type
+        if self.relation_name:
+            result += f" on {self.relation_name}"
+
+        result += f" - cost {self.total_cost} (own {self.own_cost}) - rows {self.plan_rows}"
+
+        for condition in self.conditions:
+            result += f" - {condition}"
+
+        if self.cross_join:
+            result += " - no join condition (cross join)"
+
+        return result
+
+
+@dataclass
+class QueryPlan:
+    node_type: str
+    total_cost: float
+    plan_rows: int
+    nodes: list[PlanNode] = field(default_factory=list)
+
+    def exceeds(self, max_cost: float, max_rows: int) -> bool:
+        return self.total_cost > max_cost or self.plan_rows > max_rows
+
+    def get_costliest_nodes(self, amount: int = 3) -> list[PlanNode]:
+        return sorted(self.nodes, key=lambda node: node.own_cost, reverse=True)[:amount]
+
+    def get_cross_joins(self) -> list[PlanNode]:
+        return [node for node in self.nodes if node.cross_join]
+
+    def __str__(self) -> str:
+        result = f"Plan: {self.node_type} - estimated cost {self.total_cost} - estimated rows {self.plan_rows}\n"
+        result += "Costliest node(s):\n"
+        costliest = self.get_costliest_nodes()
+        for node in costliest:
+            result += f"\t{node}\n"
+
+        cross_joins = [node for node in self.get_cross_joins() if node not in costliest]
+        if cross_joins:
+            result += "Cross join(s):\n"
+            for node in cross_joins:
+                result += f"\t{node}\n"
+
+        return result
+
+
+@dataclass
+class QueryLimits:
+    max_cost: float
+    max_rows: int
+    statement_timeout: int
+    cost_action: str
+
+    def can_cap(self, plan: QueryPlan) -> bool:
+        return self.cost_action == "limit" and plan.plan_rows > self.max_rows
+
+
+def fetch_query_limits() -> QueryLimits:
+    try:
+        limits = QueryLimits(
+            max_cost=float(getenv("QUERY_MAX_COST", "100000")),
+            max_rows=int(getenv("QUERY_MAX_ROWS", "1000")),
+            statement_timeout=int(getenv("QUERY_STATEMENT_TIMEOUT", "5000")),
+            cost_action=getenv("QUERY_COST_ACTION", "reject")
+        )
+    except ValueError as err:
+        raise ValueError(f"Invalid query limits on the environment:\n{err}")
+
+    if not isfinite(limits.max_cost):
+        raise ValueError(f"QUERY_MAX_COST must be a finite number, got '{limits.max_cost}'")
+
+    if limits.max_cost <= 0 or limits.max_rows <= 0 or limits.statement_timeout <= 0:
+        raise ValueError("QUERY_MAX_COST, QUERY_MAX_ROWS and QUERY_STATEMENT_TIMEOUT must be positive")
+
+    if limits.cost_action not in COST_ACTIONS:
+        raise ValueError(f"QUERY_COST_ACTION must be one of {sorted(COST_ACTIONS)}, got '{limits.cost_action}'")
+
+    return limits
+
+
+def check_query_plan(plan: QueryPlan, limited_plan: QueryPlan | None, limits: QueryLimits) -> str:
+    """
+    Decides what to do with a query, returns "execute", "cap" (run it wrapped
+    on a LIMIT) or "reject". limited_plan is the plan of the LIMIT wrapped query,
+    only needed when limits.can_cap(plan).
+    """
+    if not plan.exceeds(limits.max_cost, limits.max_rows):
+        return "execute"
+
+    if (
+        limits.can_cap(plan) and
+        limited_plan is not None and
+        not limited_plan.exceeds(limits.max_cost, limits.max_rows)
+    ):
+        return "cap"
+
+    return "reject"
+
+
+def is_single_statement(query: str) -> bool:
+    # psycopg2 runs every statement on the string, so a ';' could end the
+    # read only transaction and run anything after it. It is rejected even
+    # inside strings or comments, scanning SQL literals here isn't worth the risk
+    return ";" not in query
+
+
+def has_join_condition(plan: dict) -> bool:
+    if "Join Filter" in plan:
+        return True
+
+    # Index nested loops keep the join key on the inner side's Index Cond
+    inner = [child for child in plan.get("Plans", []) if child.get("Parent Relationship") == "Inner"]
+    pending = list(inner)
+    while pending:
+        node = pending.pop()
+        if "Index Cond" in node:
+            return True
+        pending.extend(node.get("Plans", []))
+
+    return False
+
+
+def parse_plan_nodes(plan: dict, nodes: list[PlanNode], scale: float = 1, once_scale: float = 1):
+    # scale turns the per loop cost of EXPLAIN into the cost of every loop,
+    # once_scale is the scale of the nearest nested loop, for nodes that run once
+    children = plan.get("Plans", [])
+    child_scales: list[tuple[float, float]] = []
+
+    for child in children:
+        if plan["Node Type"] == "Materialize":
+            child_scales.append((once_scale, once_scale))
+        elif plan["Node Type"] == "Nested Loop" and child.get("Parent Relationship") == "Inner":
+            outer_cost = sum(c["Total Cost"] for c in children if c.get("Parent Relationship") == "Outer")
+            loops_cost = plan["Total Cost"] - outer_cost
+            inner_scale = loops_cost / child["Total Cost"] if child["Total Cost"] > 0 else 1
+            child_scales.append((scale * max(inner_scale, 1), scale))
+        elif plan["Node Type"] == "Nested Loop":
+            child_scales.append((scale, scale))
+        else:
+            child_scales.append((scale, once_scale))
+
+    total_cost = plan["Total Cost"] * scale
+    own_cost = total_cost - sum(
+        child["Total Cost"] * child_scale for child, (child_scale, _) in zip(children, child_scales)
+    )
+
+    nodes.append(PlanNode(
+        node_type=plan["Node Type"],
+        total_cost=round(total_cost, 2),
+        plan_rows=plan["Plan Rows"],
+        own_cost=round(max(own_cost, 0), 2),
+        relation_name=plan.get("Relation Name"),
+        conditions=[f"{name}: {plan[name]}" for name in PLAN_CONDITIONS if name in plan],
+        cross_join=plan["Node Type"] == "Nested Loop" and not has_join_condition(plan)
+    ))
+
+    for child, (child_scale, child_once_scale) in zip(children, child_scales):
+        parse_plan_nodes(child, nodes, child_scale, child_once_scale)
+
+
+def parse_query_plan(explain: list) -> QueryPlan:
+    plan = explain[0]["Plan"]
+
+    nodes: list[PlanNode] = []
+    parse_plan_nodes(plan, nodes)
+
+    return QueryPlan(
+        node_type=plan["Node Type"],
+        total_cost=plan["Total Cost"],
+        plan_rows=plan["Plan Rows"],
+        nodes=nodes
+    )
+
+
+def fetch_query_plan(query: str, con) -> QueryPlan:
+    try:
+        with con.cursor() as cur:
+            # Explain the query wrapped the same way it will be executed.
+            # No parameters, otherwise psycopg2 tries to interpolate '%' on the query
+            cur.execute(f"""
+            EXPLAIN (FORMAT JSON)
+            SELECT *
+            FROM (
+                {query}
+            ) t
+            """)
+
+            row = cur.fetchone()
+            return parse_query_plan(row[0])
+    except Exception as err:
+        if con:
+            con.rollback()
+        raise RuntimeError(f"Crash while explaining the query:\n{err}")
+
+
 @tool
 def execute_query(query: str) -> str:
     """
@@ -342,22 +557,71 @@ def execute_query(query: str) -> str:
     NOT the raw JSON.
 
     If the result is too large, return a warning to the user instead.
+
+    Send a single SELECT statement, queries with ';' (even inside strings)
+    are rejected.
+
+    Before running, the query is checked with EXPLAIN. If it is rejected for being
+    too expensive, rewrite it using the plan summary (add filters, a LIMIT or
+    avoid cross joins) instead of retrying the same query. If the result says it
+    was capped, tell the user the answer is incomplete.
     """
     query = query.strip().rstrip(";")
+    if not is_single_statement(query):
+        return "Query rejected, send a single statement without ';' (not even inside strings)\n"
+
+    con = None
     try:
+        limits = fetch_query_limits()
         connection_string = getenv("CONNECTION_STRING")
+
         with psycopg2.connect(connection_string) as con:
+            con.set_session(readonly=True)
             with con.cursor() as cur:
+                cur.execute("SET LOCAL statement_timeout = %s", (limits.statement_timeout,))
+
+                plan = fetch_query_plan(query, con)
+                limited_query = f"""
+                SELECT *
+                FROM (
+                    {query}
+                ) limited
+                LIMIT {limits.max_rows}
+                """
+                limited_plan = None
+                if limits.can_cap(plan):
+                    limited_plan = fetch_query_plan(limited_query, con)
+
+                action = check_query_plan(plan, limited_plan, limits)
+                if action == "reject":
+                    return (
+                        "Query rejected, it is too expensive to execute\n"
+                        f"{plan}"
+                        f"Limits: cost {limits.max_cost} - rows {limits.max_rows}\n"
+                        "Rewrite the query to be cheaper (filters, LIMIT, no cross joins)\n"
+                    )
+
+                if action == "cap":
+                    query = limited_query
+
                 q = f"""
                 SELECT json_agg(row_to_json(t))
                 FROM (
                         {query}
                 ) t
                 """
-                cur.execute(q, ())
+                cur.execute(q)
                 row = cur.fetchone()
 
-                return str(row)
+                result = f"{plan}"
+                if action == "cap":
+                    result += (
+                        f"Result capped at {limits.max_rows} rows, it is INCOMPLETE. "
+                        f"The original query was estimated at cost {plan.total_cost} "
+                        f"and {plan.plan_rows} rows\n"
+                    )
+
+                return f"{result}{row}"
     except Exception as err:
         if con:
             con.rollback()
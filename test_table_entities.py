@@ -0,0 +1,168 @@
+from table_entities import (
+    QueryLimits, QueryPlan, check_query_plan, fetch_query_limits, is_single_statement, parse_query_plan
+)
+import pytest
+
+# Captured from PostgreSQL 16 with:
+# EXPLAIN (FORMAT JSON) SELECT c.name, o.total FROM customers c, orders o WHERE c.name LIKE '%1%'
+CROSS_JOIN_EXPLAIN = [{"Plan": {
+    "Node Type": "Nested Loop", "Parallel Aware": False, "Async Capable": False, "Join Type": "Inner",
+    "Startup Cost": 0.0, "Total Cost": 318598.18, "Plan Rows": 25460000, "Plan Width": 13,
+    "Inner Unique": False, "Plans": [
+        {"Node Type": "Seq Scan", "Parent Relationship": "Outer", "Parallel Aware": False,
+         "Async Capable": False, "Relation Name": "orders", "Alias": "o", "Startup Cost": 0.0,
+         "Total Cost": 309.0, "Plan Rows": 20000, "Plan Width": 5},
+        {"Node Type": "Materialize", "Parent Relationship": "Inner", "Parallel Aware": False,
+         "Async Capable": False, "Startup Cost": 0.0, "Total Cost": 42.37, "Plan Rows": 1273,
+         "Plan Width": 8, "Plans": [
+             {"Node Type": "Seq Scan", "Parent Relationship": "Outer", "Parallel Aware": False,
+              "Async Capable": False, "Relation Name": "customers", "Alias": "c", "Startup Cost": 0.0,
+              "Total Cost": 36.0, "Plan Rows": 1273, "Plan Width": 8,
+              "Filter": "(name ~~ '%1%'::text)"}]}]}}]
+
+# Captured from PostgreSQL 16 (hash and merge joins disabled) with:
+# EXPLAIN (FORMAT JSON) SELECT o.id, c.name FROM orders o JOIN customers c ON c.id = o.customer_id
+INDEX_JOIN_EXPLAIN = [{"Plan": {
+    "Node Type": "Nested Loop", "Parallel Aware": False, "Async Capable": False, "Join Type": "Inner",
+    "Startup Cost": 0.29, "Total Cost": 1406.69, "Plan Rows": 20000, "Plan Width": 12,
+    "Inner Unique": True, "Plans": [
+        {"Node Type": "Seq Scan", "Parent Relationship": "Outer", "Parallel Aware": False,
+         "Async Capable": False, "Relation Name": "orders", "Alias": "o", "Startup Cost": 0.0,
+         "Total Cost": 309.0, "Plan Rows": 20000, "Plan Width": 8},
+        {"Node Type": "Memoize", "Parent Relationship": "Inner", "Parallel Aware": False,
+         "Async Capable": False, "Startup Cost": 0.29, "Total Cost": 0.31, "Plan Rows": 1,
+         "Plan Width": 12, "Cache Key": "o.customer_id", "Cache Mode": "logical", "Plans": [
+             {"Node Type": "Index Scan", "Parent Relationship": "Outer", "Parallel Aware": False,
+              "Async Capable": False, "Scan Direction": "Forward", "Index Name": "customers_pkey",
+              "Relation Name": "customers", "Alias": "c", "Startup Cost": 0.28, "Total Cost": 0.3,
+              "Plan Rows": 1, "Plan Width": 12, "Index Cond": "(id = o.customer_id)"}]}]}}]
+
+
+def make_plan(total_cost: float, plan_rows: int) -> QueryPlan:
+    return QueryPlan(node_type="Seq Scan", total_cost=total_cost, plan_rows=plan_rows)
+
+
+def make_limits(cost_action: str) -> QueryLimits:
+    return QueryLimits(max_cost=1000, max_rows=100, statement_timeout=5000, cost_action=cost_action)
+
+
+def test_parse_query_plan_uses_root_for_totals():
+    plan = parse_query_plan(CROSS_JOIN_EXPLAIN)
+
+    assert plan.node_type == "Nested Loop"
+    assert plan.total_cost == 318598.18
+    assert plan.plan_rows == 25460000
+    assert len(plan.nodes) == 4
+
+
+def test_parse_query_plan_walks_child_nodes():
+    plan = parse_query_plan(CROSS_JOIN_EXPLAIN)
+    scan = [node for node in plan.nodes if node.relation_name == "customers"][0]
+
+    assert scan.node_type == "Seq Scan"
+    assert scan.conditions == ["Filter: (name ~~ '%1%'::text)"]
+    # Below a Materialize the scan runs only once
+    assert scan.total_cost == 36.0
+
+
+def test_cross_join_is_flagged():
+    plan = parse_query_plan(CROSS_JOIN_EXPLAIN)
+    nested_loop = plan.nodes[0]
+
+    assert nested_loop.cross_join
+    assert plan.get_cross_joins() == [nested_loop]
+    # Rescanning the materialized rows is what makes the cross join expensive
+    assert plan.get_costliest_nodes(1)[0].node_type == "Materialize"
+    assert "no join condition (cross join)" in str(plan)
+
+
+def test_index_nested_loop_is_not_a_cross_join():
+    plan = parse_query_plan(INDEX_JOIN_EXPLAIN)
+
+    assert plan.get_cross_joins() == []
+    assert "cross join" not in str(plan)
+    # The repeated lookups are charged to the index scan, not to the nested loop
+    costliest = plan.get_costliest_nodes(1)[0]
+    assert costliest.node_type == "Index Scan"
+    assert costliest.relation_name == "customers"
+    assert plan.nodes[0].own_cost == 0
+
+
+@pytest.mark.parametrize("total_cost, plan_rows, expected", [
+    (10, 10, False),
+    (100, 1000, False),
+    (100.01, 1, True),
+    (1, 1001, True),
+])
+def test_query_plan_exceeds(total_cost, plan_rows, expected):
+    plan = make_plan(total_cost, plan_rows)
+
+    assert plan.exceeds(max_cost=100, max_rows=1000) == expected
+
+
+def test_fetch_query_limits_defaults(monkeypatch):
+    for name in ["QUERY_MAX_COST", "QUERY_MAX_ROWS", "QUERY_STATEMENT_TIMEOUT", "QUERY_COST_ACTION"]:
+        monkeypatch.delenv(name, raising=False)
+
+    limits = fetch_query_limits()
+
+    assert limits.max_cost == 100000
+    assert limits.max_rows == 1000
+    assert limits.statement_timeout == 5000
+    assert limits.cost_action == "reject"
+
+
+@pytest.mark.parametrize("name, value", [
+    ("QUERY_MAX_ROWS", "1e3"),
+    ("QUERY_MAX_COST", "-1"),
+    ("QUERY_MAX_COST", "nan"),
+    ("QUERY_MAX_COST", "inf"),
+    ("QUERY_STATEMENT_TIMEOUT", "0"),
+    ("QUERY_COST_ACTION", "Limit"),
+])
+def test_fetch_query_limits_rejects_invalid_values(monkeypatch, name, value):
+    monkeypatch.setenv(name, value)
+
+    with pytest.raises(ValueError):
+        fetch_query_limits()
+
+
+def test_check_query_plan_executes_cheap_queries():
+    assert check_query_plan(make_plan(10, 10), None, make_limits("reject")) == "execute"
+    assert check_query_plan(make_plan(10, 10), None, make_limits("limit")) == "execute"
+
+
+def test_check_query_plan_rejects_on_reject_mode():
+    assert check_query_plan(make_plan(10, 5000), make_plan(5, 100), make_limits("reject")) == "reject"
+
+
+def test_check_query_plan_caps_on_limit_mode():
+    limits = make_limits("limit")
+
+    assert limits.can_cap(make_plan(10, 5000))
+    assert check_query_plan(make_plan(10, 5000), make_plan(5, 100), limits) == "cap"
+
+
+def test_check_query_plan_rejects_when_the_capped_plan_is_still_expensive():
+    assert check_query_plan(make_plan(50000, 5000), make_plan(2000, 100), make_limits("limit")) == "reject"
+
+
+def test_check_query_plan_rejects_expensive_queries_with_few_rows():
+    # A LIMIT wouldn't change an aggregate that returns a single row
+    limits = make_limits("limit")
+
+    assert not limits.can_cap(make_plan(50000, 1))
+    assert check_query_plan(make_plan(50000, 1), None, limits) == "reject"
+
+
+@pytest.mark.parametrize("query", [
+    "SELECT 1; COMMIT; SET statement_timeout = 0; SELECT * FROM orders, customers",
+    "SELECT 1) t; COMMIT; SELECT * FROM (SELECT 1",
+    "SELECT name FROM customers WHERE name = 'a;b'",
+])
+def test_multiple_statements_are_rejected(query):
+    assert not is_single_statement(query)
+
+
+def test_single_statement_is_accepted():
+    assert is_single_statement("SELECT name FROM customers WHERE name LIKE '%1%'")